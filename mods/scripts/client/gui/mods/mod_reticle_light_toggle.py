@@ -11,7 +11,6 @@ from __future__ import absolute_import, division, print_function
 
 import json
 import os
-import weakref
 
 import BigWorld
 import Keys
@@ -23,6 +22,11 @@ from skeletons.account_helpers.settings_core import ISettingsCore
 from skeletons.gui.app_loader import IAppLoader
 from skeletons.gui.battle_session import IBattleSessionProvider
 
+try:
+    from gui.app_loader.settings import GUI_GLOBAL_SPACE_ID
+except ImportError:
+    GUI_GLOBAL_SPACE_ID = None
+
 MOD_ID = 'reticleLightToggle'
 MOD_NAME = 'Переключатель света прицела'
 MOD_DESCRIPTION = 'Переключает цвет прицела по ПКМ и позволяет настраивать цвета.'
@@ -36,49 +40,96 @@ DEFAULT_CONFIG = {
     'alternateColor': '#00FFDE',
     'startWithAlternateColor': False,
 }
+_CONFIG_KEYS = tuple(DEFAULT_CONFIG)
+_CONFIG_KEY_SET = frozenset(DEFAULT_CONFIG)
+
+_KEY_RIGHTMOUSE = Keys.KEY_RIGHTMOUSE
+# Without the named space id the right click hook cannot be deferred to the
+# first battle and is installed at startup instead.
+_BATTLE_SPACE_ID = GUI_GLOBAL_SPACE_ID.BATTLE if GUI_GLOBAL_SPACE_ID is not None else 1
+_CONTROL_MODE_NAMES = ('ArcadeControlMode', 'SniperControlMode', 'StrategicControlMode', 'DualGunControlMode')
+
+# (setting, control type, label) for the modsListApi settings window.
+_SETTINGS_CONTROLS = (
+    ('enabled', 'CheckBox', 'Включить мод'),
+    ('baseColor', 'Color', 'Основной цвет прицела'),
+    ('alternateColor', 'Color', 'Альтернативный цвет прицела'),
+    ('startWithAlternateColor', 'CheckBox', 'Начинать бой с альтернативным цветом'),
+)
+
+
+_configDirectoryReady = False
 
 
 def _ensureConfigDirectory():
+    global _configDirectoryReady
+    if _configDirectoryReady:
+        return
+    # os.makedirs() has no exist_ok on the client's Python 2.7.
     if not os.path.isdir(CONFIG_DIRECTORY):
         try:
             os.makedirs(CONFIG_DIRECTORY)
         except Exception:  # pragma: no cover - directory creation is best effort
             LOG_CURRENT_EXCEPTION('%s: failed to create config directory' % MOD_ID)
+            return
+    _configDirectoryReady = True
 
 
 class _ModConfig(object):
-    __slots__ = ('enabled', 'baseColor', 'alternateColor', 'startWithAlternateColor')
+    # Parsed contents of settings.json shared between instances, keyed by the
+    # file mtime so unchanged files are not parsed again.
+    _cachedMtime = None
+    _cachedData = None
 
     def __init__(self):
-        for key, value in DEFAULT_CONFIG.items():
-            setattr(self, key, value)
+        # Keep in sync with DEFAULT_CONFIG.
+        self.enabled = True
+        self.baseColor = '#FFCC00'
+        self.alternateColor = '#00FFDE'
+        self.startWithAlternateColor = False
         self.load()
 
     def load(self):
-        _ensureConfigDirectory()
-        if not os.path.isfile(CONFIG_PATH):
-            return
+        global _configDirectoryReady
         try:
-            with open(CONFIG_PATH, 'r') as fp:
-                data = json.load(fp)
-        except Exception:
-            LOG_CURRENT_EXCEPTION('%s: unable to read config, using defaults' % MOD_ID)
+            mtime = os.stat(CONFIG_PATH).st_mtime
+        except OSError:
             return
-        for key in DEFAULT_CONFIG:
-            if key in data:
-                setattr(self, key, data[key])
+        # Reading does not need the directory to be created, and a config file
+        # that exists means save() can skip its own directory check.
+        _configDirectoryReady = True
+        cls = type(self)
+        if mtime == cls._cachedMtime:
+            data = cls._cachedData
+        else:
+            try:
+                with open(CONFIG_PATH, 'r') as fp:
+                    data = json.load(fp)
+            except Exception:
+                LOG_CURRENT_EXCEPTION('%s: unable to read config, using defaults' % MOD_ID)
+                return
+            cls._cachedMtime = mtime
+            cls._cachedData = data
+        self.__dict__.update((key, data[key]) for key in _CONFIG_KEY_SET.intersection(data))
 
     def save(self):
         _ensureConfigDirectory()
-        data = {key: getattr(self, key) for key in DEFAULT_CONFIG}
+        data = self.asDict()
+        cls = type(self)
+        cls._cachedMtime = cls._cachedData = None
         try:
             with open(CONFIG_PATH, 'w') as fp:
-                json.dump(data, fp, indent=4, sort_keys=True)
+                # Explicit separators avoid the trailing spaces Python 2 emits with indent.
+                json.dump(data, fp, indent=4, separators=(',', ': '), sort_keys=True)
+                fp.write('\n')
+            cls._cachedMtime = os.stat(CONFIG_PATH).st_mtime
+            cls._cachedData = data
         except Exception:
             LOG_CURRENT_EXCEPTION('%s: unable to save config' % MOD_ID)
 
     def asDict(self):
-        return {key: getattr(self, key) for key in DEFAULT_CONFIG}
+        values = self.__dict__
+        return {key: values[key] for key in _CONFIG_KEYS}
 
 
 class _ReticleColorController(object):
@@ -90,16 +141,27 @@ class _ReticleColorController(object):
         self._useAlternate = bool(config.startWithAlternateColor)
         self._isInstalled = False
         self._pendingUpdate = False
+        self._applyController = None
+        self._applyFn = None
+        self._colorSetting = None
+        self._lastHex = None
+        self._lastApplied = None
 
     def install(self):
         if self._isInstalled:
             return
         self._isInstalled = True
+        self._lastApplied = None
         if self._config.enabled:
             self.applyCurrentColor()
 
     def uninstall(self):
         self._isInstalled = False
+        self._applyController = None
+        self._applyFn = None
+        self._colorSetting = None
+        self._lastHex = None
+        self._lastApplied = None
 
     def toggle(self):
         if not self._config.enabled:
@@ -115,108 +177,151 @@ class _ReticleColorController(object):
 
     def applyCurrentColor(self):
         color = self._config.alternateColor if self._useAlternate else self._config.baseColor
+        if color == self._lastApplied and not self._pendingUpdate:
+            return
         if not self._applyGunMarkerColor(color):
             self._pendingUpdate = True
+            self._lastApplied = None
             LOG_NOTE('%s: gun marker controller not ready, defer color update' % MOD_ID)
         else:
             self._pendingUpdate = False
+            self._lastApplied = color
 
     def onAvatarReady(self):
         if self._pendingUpdate:
             self.applyCurrentColor()
 
+    def onBattleLeft(self):
+        # Do not keep the finished battle's crosshair controller alive.
+        self._applyController = None
+        self._applyFn = None
+
     def _applyGunMarkerColor(self, hexColor):
         controller = None
         if self.sessionProvider is not None:
             controller = getattr(self.sessionProvider.shared, 'crosshair', None)
         if controller is not None:
-            # Crosshair controller API differs between versions.  We try the most
-            # common methods in a safe order.
-            try:
-                if hasattr(controller, 'setOverrideReticleColor'):
-                    controller.setOverrideReticleColor(hexColor)
-                    return True
-                if hasattr(controller, 'setReticleColor'):  # old API
-                    controller.setReticleColor(hexColor)
+            if controller is self._applyController:
+                applyFn = self._applyFn
+            else:
+                applyFn = self._resolveApplyFn(controller)
+            if applyFn is not None:
+                try:
+                    applyFn(hexColor)
+                    # The settings value no longer matches what is displayed.
+                    self._lastHex = None
                     return True
-            except Exception:
-                LOG_CURRENT_EXCEPTION('%s: failed to apply color through crosshair controller' % MOD_ID)
+                except Exception:
+                    LOG_CURRENT_EXCEPTION('%s: failed to apply color through crosshair controller' % MOD_ID)
+        elif self._applyController is not None:
+            self.onBattleLeft()
         # Fallback: push the color through settings so the game rebuilds the markers.
         return self._applyThroughSettings(hexColor)
 
+    def _resolveApplyFn(self, controller):
+        # Crosshair controller API differs between versions.  We try the most
+        # common methods in a safe order and remember the result until the
+        # crosshair controller instance changes.
+        applyFn = getattr(controller, 'setOverrideReticleColor', None)
+        if applyFn is None:
+            applyFn = getattr(controller, 'setReticleColor', None)  # old API
+        self._applyController = controller
+        self._applyFn = applyFn
+        return applyFn
+
+    def _resolveColorSetting(self):
+        if self.settingsCore is None:
+            return None
+        options = self.settingsCore.options
+        if options is None:
+            return None
+        return options.getSetting(CROSSHAIR_PANEL.GUN_MARKER_COLOR)
+
     def _applyThroughSettings(self, hexColor):
+        if hexColor == self._lastHex:
+            # colorSetting.apply() rebuilds the markers; skip it for no-op writes.
+            return True
         try:
-            if self.settingsCore is None:
-                return False
-            options = self.settingsCore.options
-            if options is None:
-                return False
-            colorSetting = options.getSetting(CROSSHAIR_PANEL.GUN_MARKER_COLOR)
+            colorSetting = self._colorSetting
             if colorSetting is None:
-                return False
+                colorSetting = self._resolveColorSetting()
+                if colorSetting is None:
+                    return False
+                self._colorSetting = colorSetting
             values = colorSetting.getSystemValue()
             # The structure is typically {'arcade': '#rrggbb', 'sniper': '#rrggbb', ...}
             if isinstance(values, dict):
-                for key in values:
-                    values[key] = hexColor
+                values = dict.fromkeys(values, hexColor)
             colorSetting.setSystemValue(values)
             colorSetting.apply()
+            self._lastHex = hexColor
             return True
         except Exception:
+            self._colorSetting = None
             LOG_CURRENT_EXCEPTION('%s: unable to write color through settings core' % MOD_ID)
         return False
 
 
 class _RightClickHook(object):
     def __init__(self, controller):
-        self.__controllerRef = weakref.ref(controller)
-        self.__patchedClasses = []
+        self.__controller = controller
+        self.__patches = []
+        self.__patched = set()
+        self.__isInstalled = False
+
+    def __makeWrapper(self, original):
+        # Each patched class gets its own wrapper bound to the handler it
+        # replaced, so a wrapped override calling a wrapped base handler
+        # reaches that base's original rather than its own.
+        controller = self.__controller
+
+        def wrapper(instance, event, _original=original, _rightMouse=_KEY_RIGHTMOUSE, _getattr=getattr):
+            # Most mouse events are moves, wheel or other buttons: reject them
+            # on the key code before touching isButtonDown().
+            key = _getattr(event, 'button', None)
+            if key is None:
+                key = _getattr(event, 'key', None)
+            if key == _rightMouse:
+                try:
+                    isDown = event.isButtonDown()
+                except Exception:
+                    LOG_CURRENT_EXCEPTION('%s: error while processing mouse event' % MOD_ID)
+                    isDown = False
+                if isDown:
+                    controller.toggle()
+                    return True
+            return _original(instance, event)
+        return wrapper
 
     def install(self):
+        if self.__isInstalled or self.__controller is None:  # installed or disposed
+            return
         from AvatarInputHandler import control_modes
-        classes = []
-        for name in ('ArcadeControlMode', 'SniperControlMode', 'StrategicControlMode', 'DualGunControlMode'):
-            cls = getattr(control_modes, name, None)
-            if cls is not None:
-                classes.append(cls)
+        namespace = control_modes.__dict__
+        classes = [cls for cls in (namespace.get(name) for name in _CONTROL_MODE_NAMES) if cls is not None]
+        patched = self.__patched
         for cls in classes:
-            if hasattr(cls, 'handleMouseEvent') and cls not in self.__patchedClasses:
+            if hasattr(cls, 'handleMouseEvent') and cls not in patched:
+                owner = next((base for base in cls.__mro__ if 'handleMouseEvent' in base.__dict__), cls)
+                if owner is not cls and owner in patched:
+                    # Inherits the wrapper of a patched base class.
+                    continue
                 original = cls.handleMouseEvent
-
-                def makeWrapper(method):
-                    def wrapper(instance, event):
-                        if self.__shouldToggle(event):
-                            controller = self.__controllerRef()
-                            if controller is not None:
-                                controller.toggle()
-                                return True
-                        return method(instance, event)
-                    wrapper.__original__ = method
-                    return wrapper
-
-                cls.handleMouseEvent = makeWrapper(original)
-                self.__patchedClasses.append(cls)
+                patched.add(cls)
+                cls.handleMouseEvent = self.__makeWrapper(original)
+                self.__patches.append((cls, original))
+        self.__isInstalled = True
 
     def uninstall(self):
-        for cls in self.__patchedClasses:
-            if hasattr(cls, 'handleMouseEvent'):
-                handler = cls.handleMouseEvent
-                original = getattr(handler, '__original__', None)
-                if original is not None:
-                    cls.handleMouseEvent = original
-        self.__patchedClasses = []
-
-    @staticmethod
-    def __shouldToggle(event):
-        try:
-            if event is None:
-                return False
-            if hasattr(event, 'isButtonDown') and event.isButtonDown():
-                key = getattr(event, 'button', getattr(event, 'key', None))
-                return key == Keys.KEY_RIGHTMOUSE
-        except Exception:
-            LOG_CURRENT_EXCEPTION('%s: error while processing mouse event' % MOD_ID)
-        return False
+        for cls, original in self.__patches:
+            cls.handleMouseEvent = original
+        self.__patches = []
+        self.__patched.clear()
+        self.__isInstalled = False
+
+    def dispose(self):
+        self.uninstall()
+        self.__controller = None
 
 
 class _ModEntryPoint(object):
@@ -224,11 +329,12 @@ class _ModEntryPoint(object):
 
     def __init__(self):
         self._config = _ModConfig()
+        self._modsListApi = None
         self._controller = _ReticleColorController(self._config)
         self._rightClickHook = _RightClickHook(self._controller)
         self._registerHangarEntry()
-        self._installBattleListeners()
-        self._rightClickHook.install()
+        if not self._installBattleListeners() or GUI_GLOBAL_SPACE_ID is None:
+            self._rightClickHook.install()
         self._controller.install()
         LOG_NOTE('%s: initialization complete' % MOD_ID)
 
@@ -240,6 +346,7 @@ class _ModEntryPoint(object):
             g_modsListApi = None
         if g_modsListApi is None:
             return
+        self._modsListApi = g_modsListApi
         g_modsListApi.addMod(
             modId=MOD_ID,
             name=MOD_NAME,
@@ -249,66 +356,53 @@ class _ModEntryPoint(object):
         )
 
     def __openSettingsWindow(self):
-        try:
-            from gui.modsListApi import g_modsListApi
-        except Exception:
-            g_modsListApi = None
-        if g_modsListApi is None:
+        modsListApi = self._modsListApi
+        if modsListApi is None:
             return
+        config = self._config
         controls = [
-            {
-                'type': 'CheckBox',
-                'label': 'Включить мод',
-                'setting': 'enabled',
-                'value': self._config.enabled,
-            },
-            {
-                'type': 'Color',
-                'label': 'Основной цвет прицела',
-                'setting': 'baseColor',
-                'value': self._config.baseColor,
-            },
-            {
-                'type': 'Color',
-                'label': 'Альтернативный цвет прицела',
-                'setting': 'alternateColor',
-                'value': self._config.alternateColor,
-            },
-            {
-                'type': 'CheckBox',
-                'label': 'Начинать бой с альтернативным цветом',
-                'setting': 'startWithAlternateColor',
-                'value': self._config.startWithAlternateColor,
-            },
+            {'type': controlType, 'label': label, 'setting': setting, 'value': getattr(config, setting)}
+            for setting, controlType, label in _SETTINGS_CONTROLS
         ]
         try:
-            g_modsListApi.showSettings(modId=MOD_ID, title=MOD_NAME, controls=controls, callback=self.__onSettingsChanged)
+            modsListApi.showSettings(modId=MOD_ID, title=MOD_NAME, controls=controls, callback=self.__onSettingsChanged)
         except Exception:
             LOG_CURRENT_EXCEPTION('%s: unable to open settings window via modsListApi' % MOD_ID)
 
     def __onSettingsChanged(self, data):
         if not isinstance(data, dict):
             return
-        for key in DEFAULT_CONFIG:
-            if key in data:
-                setattr(self._config, key, data[key])
+        for key in _CONFIG_KEY_SET.intersection(data):
+            setattr(self._config, key, data[key])
         self._config.save()
         self._controller.refreshFromConfig(self._config)
 
     def _installBattleListeners(self):
         loader = self.appLoader
         if loader is None:
-            return
+            return False
         try:
             loader.onGUISpaceEntered += self.__onGUISpaceEntered
         except Exception:
             LOG_CURRENT_EXCEPTION('%s: unable to subscribe to GUI space events' % MOD_ID)
+            return False
+        return True
 
     def __onGUISpaceEntered(self, spaceID):
+        isBattle = spaceID == _BATTLE_SPACE_ID
+        if isBattle:
+            # Control modes live in battle-only modules, so the mouse hook is
+            # installed on the first battle rather than at hangar startup.
+            try:
+                self._rightClickHook.install()
+            except Exception:
+                LOG_CURRENT_EXCEPTION('%s: unable to install right click hook' % MOD_ID)
+        else:
+            self._controller.onBattleLeft()
         player = BigWorld.player() if hasattr(BigWorld, 'player') else None
         if player is None:
             return
-        if spaceID == 1:  # Battle space
+        if isBattle:
             try:
                 player.onVehicleEnterWorld += self.__onAvatarReady
             except Exception:
@@ -322,6 +416,16 @@ class _ModEntryPoint(object):
     def __onAvatarReady(self, *_, **__):
         self._controller.onAvatarReady()
 
+    def dispose(self):
+        loader = self.appLoader
+        if loader is not None:
+            try:
+                loader.onGUISpaceEntered -= self.__onGUISpaceEntered
+            except Exception:
+                pass
+        self._rightClickHook.dispose()
+        self._controller.uninstall()
+
 
 _modInstance = None
 
@@ -332,4 +436,11 @@ def init():
         _modInstance = _ModEntryPoint()
 
 
+def fini():
+    global _modInstance
+    if _modInstance is not None:
+        _modInstance.dispose()
+        _modInstance = None
+
+
 init()